@@ -2,9 +2,13 @@ from colorama import init, Fore, Back, Style
 import sys
 import os.path
 import json
+import shutil
 import pprint
 import re
 import argparse
+from dataclasses import dataclass
+
+from asm_fixer_core import classify_line, BlankLine, Comment, Directive, Data, Procedure, Instruction, Error
 
 pp = pprint.PrettyPrinter(indent=2, width=200)
 
@@ -46,6 +50,29 @@ DEFAULT_CONFIG = {
     'align_header_comments': True,
 }
 
+_RE_SPLIT_COMMA = re.compile(r', ?')
+
+
+@dataclass(slots=True)
+class OutputLine:
+    string: str
+    comment: str | None = None
+    is_data: bool = False
+    skip_wrap: bool = False
+
+
+def _wrap_line(line, width, continuation):
+    wrapped_lines = []
+    while len(line) > width:
+        last_space = line.rfind(' ', 0, width + 1)
+        # A word that cannot fit after the continuation is left overlong
+        if last_space < len(continuation):
+            break
+        wrapped_lines.append(line[:last_space])
+        line = continuation + line[last_space + 1:]
+    wrapped_lines.append(line)
+    return wrapped_lines
+
 
 def main():
     init(autoreset=True)
@@ -75,11 +102,11 @@ def main():
     # Process config
     if not os.path.isfile(config_file_name):
         config = DEFAULT_CONFIG
-        with open(config_file_name, 'w+') as new_config_file:
+        with open(config_file_name, 'w') as new_config_file:
             json.dump(config, new_config_file, indent=2)
     else:
         with open(config_file_name, 'r') as config_file:
-            config = json.loads(config_file.read())
+            config = json.load(config_file)
 
         if config['_CONFIG_VERSION'] != DEFAULT_CONFIG['_CONFIG_VERSION']:
             print(Fore.YELLOW + 'Warning: config file out of date; updating...')
@@ -92,237 +119,169 @@ def main():
                 json.dump(new_config, config_file, indent=2)
             config = new_config
 
-    # Read file
-    with open(file_name, 'r') as file:
-        lines = file.readlines()
+    # Unpack config
+    fix_indents = config['fix_indents']
+    tab_size = config['tab_size']
+    fix_file_width = config['fix_file_width']
+    file_width = config['file_width']
+    long_comment_indent_amount = config['long_comment_indent_amount']
+    fix_capitalization = config['fix_capitalization']
+    fix_blank_lines = config['fix_blank_lines']
+    align_comments = config['align_comments']
+    align_data_comments = config['align_data_comments']
+    align_data_comments_separately = config['align_data_comments_separately']
+    min_comment_spacing = config['min_comment_spacing']
+    align_code_section = config['align_code_section']
+    min_instruction_operand_spacing = config['min_instruction_operand_spacing']
+    add_spaces_between_operands = config['add_spaces_between_operands']
+    align_data_section = config['align_data_section']
+    align_code_and_data_together = config['align_code_and_data_together']
+    min_data_directive_spacing = config['min_data_directive_spacing']
+    min_data_initial_value_spacing = config['min_data_initial_value_spacing']
+    add_spaces_between_initial_values = config['add_spaces_between_initial_values']
+    align_header_comments = config['align_header_comments']
+
+    # Back up file
     if safe_mode:
-        with open(backup_file_name, 'w+') as file:
-            file.write(''.join(lines))
+        shutil.copyfile(file_name, backup_file_name)
 
     # Parse lines of file
     tokens = []
-    for line in lines:
-        # Preprocess Line
-        indent = re.match(r'^[ \t]*', line).group(0).replace('\t', ' ' * config['tab_size'])
-        line = line.strip()
-
-        # Blank Line
-        if len(line) == 0:
-            tokens.append({
-                'type': 'blank_line'
-            })
-        # Comment Extension
-        elif line.startswith(';  '):
-            tokens.append({
-                'type': 'comment',
-                'subtype': 'extension',
-                'value': line[1:].strip()
-            })
-        # Header Comment
-        elif re.search(r';.*(Author|Assignment|Date).*:', line, re.IGNORECASE):
-            tokens.append({
-                'type': 'comment',
-                'subtype': 'header',
-                'field': line[1:line.find(':')].strip(),
-                'value': line[line.find(':') + 1:].strip()
-            })
-        # Full-line Comment
-        elif line.startswith(';'):
-            tokens.append({
-                'type': 'comment',
-                'subtype': 'full_line',
-                'value': line[1:].strip()
-            })
-        # Directive
-        elif line.startswith('.') or line.startswith('INCLUDE') or line.startswith('END', re.IGNORECASE):
-            tokens.append({
-                'type': 'directive',
-                'value': re.match(r'\.?([a-zA-Z0-9.] ?)+', line).group(0).strip(),
-                'comment': line[line.find(';') + 2:] if line.find(';') > 0 else None
-            })
-        # Data Value
-        elif re.search(r'^([a-zA-Z_][a-zA-Z0-9_]+)[ \t]+(BYTE|D?Q?WORD)[ \t]+(([0-9a-zA-Z,()?] ?|".+")+)', line, re.IGNORECASE):
-            match = re.search(r'([a-zA-Z_][a-zA-Z0-9_]+)[ \t]+(BYTE|D?Q?WORD)[ \t]+(([0-9a-zA-Z,()?] ?|".+")+)', line, re.IGNORECASE)
-            tokens.append({
-                'type': 'data',
-                'label': match.group(1),
-                'directive': match.group(2),
-                'value': match.group(3).strip() if match.group(3) is not None else None,
-                'comment': line[line.find(';') + 2:] if line.find(';') > 0 else None
-            })
-        # Procedure
-        elif re.search(r'^([a-zA-Z_][a-zA-Z0-9_]*)[ \t]+(PROC|ENDP)', line):
-            match = re.search(r'([a-zA-Z_][a-zA-Z0-9_]*)[ \t]+(PROC|ENDP)', line)
-            tokens.append({
-                'type': 'procedure',
-                'label': match.group(1),
-                'value': match.group(2),
-                'comment': line[line.find(';') + 2:] if line.find(';') > 0 else None
-            })
-        # Instruction/Macro
-        elif re.search(r'^([a-zA-Z][a-zA-Z0-9]*)([ \t]+(([0-9a-zA-Z,] ?)+))?', line):
-            match = re.search(r'^([a-zA-Z][a-zA-Z0-9]*)([ \t]+(([0-9a-zA-Z,] ?)+))?', line)
-            tokens.append({
-                'type': 'instruction',
-                'mnemonic': match.group(1),
-                'operands': match.group(3).strip() if match.group(3) is not None else None,
-                'comment': line[line.find(';') + 2:] if line.find(';') > 0 else None
-            })
-        # Unrecognized
-        else:
-            tokens.append({
-                'type': 'error',
-                'error': 'Unrecognized Token',
-                'value': line
-            })
-
-        # If fix_indents is disabled, add the indent back
-        if not config['fix_indents']:
-            tokens[-1]['indent'] = indent
-
-    # Process Tokens
+    prev_token = None
     max_field_size = 0
     max_label_size = 0
     max_size_size = 0
     max_mnemonic_size = 0
-    for i in range(len(tokens)):
-        if config['fix_file_width'] and i > 0 and tokens[i]['type'] == 'comment' and tokens[i]['subtype'] == 'extension':
-            if tokens[i - 1]['type'] == 'comment':
-                tokens[i - 1]['value'] += ' ' + tokens[i]['value']
-            else:
-                tokens[i - 1]['comment'] = (tokens[i - 1]['comment'] or '') + ' ' + tokens[i]['value']
-            tokens[i]['type'] = 'to_remove'
-        if config['fix_capitalization']:
-            if 'mnemonic' in tokens[i]:
-                tokens[i]['mnemonic'] = tokens[i]['mnemonic'].lower()
-            if 'directive' in tokens[i]:
-                tokens[i]['directive'] = tokens[i]['directive'].upper()
-            if tokens[i]['type'] == 'directive':
-                tokens[i]['value'] = tokens[i]['value'].upper()
-        if tokens[i]['type'] == 'error':
-            print(Fore.RED + f'Error on line {i+1}:' + tokens[i]['error'] + '\n  ' + tokens[i]['value'])
-        elif tokens[i]['type'] == 'data':
-            max_label_size = max(max_label_size, len(tokens[i]['label']))
-            max_size_size = max(max_size_size, len(tokens[i]['directive']))
-            if config['add_spaces_between_initial_values'] and tokens[i]['value'] is not None:
-                tokens[i]['value'] = ', '.join(re.split(f', ?', tokens[i]['value']))
-        elif tokens[i]['type'] == 'instruction':
-            max_mnemonic_size = max(max_mnemonic_size, len(tokens[i]['mnemonic']))
-            if config['add_spaces_between_operands'] and tokens[i]['operands'] is not None:
-                tokens[i]['operands'] = ', '.join(re.split(f', ?', tokens[i]['operands']))
-        elif config['fix_blank_lines'] and i > 0 and tokens[i]['type'] == 'blank_line':
-            if tokens[i - 1]['type'] == 'blank_line':
-                tokens[i]['type'] = 'to_remove'
-        elif tokens[i]['type'] == 'comment' and tokens[i]['subtype'] == 'header':
-            max_field_size = max(max_field_size, len(tokens[i]['field']))
-
-    if config['align_code_and_data_together']:
+    with open(file_name, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            token = classify_line(line, tab_size, not fix_indents)
+            match token:
+                case Comment(subtype='header'):
+                    max_field_size = max(max_field_size, len(token.field))
+                case Directive():
+                    if fix_capitalization:
+                        token.value = token.value.upper()
+                case Data():
+                    if fix_capitalization:
+                        token.directive = token.directive.upper()
+                    if add_spaces_between_initial_values:
+                        token.value = ', '.join(_RE_SPLIT_COMMA.split(token.value))
+                    max_label_size = max(max_label_size, len(token.label))
+                    max_size_size = max(max_size_size, len(token.directive))
+                case Instruction():
+                    if fix_capitalization:
+                        token.mnemonic = token.mnemonic.lower()
+                    if add_spaces_between_operands and token.operands is not None:
+                        token.operands = ', '.join(_RE_SPLIT_COMMA.split(token.operands))
+                    max_mnemonic_size = max(max_mnemonic_size, len(token.mnemonic))
+                case Error():
+                    print(Fore.RED + f'Error on line {line_number}:' + token.error + '\n  ' + token.value)
+
+            # Merge comment extensions into the previous token and drop repeated blank lines
+            if prev_token is not None:
+                if fix_file_width and isinstance(token, Comment) and token.subtype == 'extension':
+                    if isinstance(prev_token, Comment):
+                        prev_token.value += ' ' + token.value
+                    else:
+                        prev_token.comment = (prev_token.comment or '') + ' ' + token.value
+                    continue
+                if fix_blank_lines and isinstance(token, BlankLine) and isinstance(prev_token, BlankLine):
+                    continue
+
+            tokens.append(token)
+            prev_token = token
+
+    if align_code_and_data_together:
         max_label_size = max_mnemonic_size = max(max_label_size, max_mnemonic_size)
-        config['min_instruction_operand_spacing'] = config['min_data_directive_spacing'] = max(config['min_instruction_operand_spacing'], config['min_data_directive_spacing'])
+        min_instruction_operand_spacing = min_data_directive_spacing = max(min_instruction_operand_spacing, min_data_directive_spacing)
 
-    tokens = [x for x in tokens if x['type'] != 'to_remove']
+    # Build line formats now that the column widths are known
+    header_width = len('; : ') + max_field_size
+    header_continuation = '; '.ljust(header_width)
+    directive_format = f'{{:<{max_size_size + min_data_initial_value_spacing}}}{{}}'
+    if align_data_section:
+        format_data = (f'{{:<{max_label_size + min_data_directive_spacing}}}' + directive_format).format
+    else:
+        format_data = ('{}' + ' ' * min_data_directive_spacing + directive_format).format
+    if align_code_section:
+        format_instruction = f'{{:<{max_mnemonic_size + min_instruction_operand_spacing}}}{{}}'.format
+    else:
+        format_instruction = ('{}' + ' ' * min_instruction_operand_spacing + '{}').format
 
     # Parse Tokens
     parsed_tokens = []
     max_string_size = 0
     max_data_string_size = 0
     indent_counter = 0
+    indent_string = ''
     for token in tokens:
-        if token['type'] == 'comment':
-            if token['subtype'] == 'header':
-                if config['align_header_comments']:
-                    line = f'; {token["field"] + ":"}'.ljust(len('; : ') + max_field_size) + token['value']
+        match token:
+            case Instruction():
+                output_line = OutputLine(format_instruction(token.mnemonic, token.operands or ''), token.comment)
+            case Data():
+                output_line = OutputLine(format_data(token.label, token.directive, token.value), token.comment, is_data=True)
+                if align_data_comments and align_data_comments_separately:
+                    max_data_string_size = max(max_data_string_size, len(output_line.string))
+            case Comment(subtype='full_line'):
+                output_line = OutputLine(f'; {token.value}')
+            case BlankLine():
+                output_line = OutputLine('')
+            case Directive():
+                output_line = OutputLine(token.value, token.comment)
+            case Comment(subtype='header'):
+                indent = indent_string if fix_indents else token.indent
+                if align_header_comments:
+                    line = f'; {token.field}:'.ljust(header_width) + token.value
                 else:
-                    line = f'; {token["field"]}: {token["value"]}'
-                if config['fix_file_width'] and len(line) > config['file_width']:
-                    while len(line) > config['file_width']:
-                        last_space = line.rfind(' ', 0, config['file_width'])
-                        parsed_tokens.append(line[:last_space])
-                        line = '; '.ljust(len('; : ') + max_field_size) + line[last_space + 1:]
-                    parsed_tokens.append(line)
+                    line = f'; {token.field}: {token.value}'
+                if fix_file_width:
+                    parsed_tokens.extend(OutputLine(wrapped_line, skip_wrap=True) for wrapped_line in _wrap_line(indent + line, file_width, indent + header_continuation))
                 else:
-                    parsed_tokens.append(line)
-            elif token['subtype'] == 'full_line':
-                parsed_tokens.append({
-                    'str': f'; {token["value"]}',
-                    'comment': None
-                })
-        elif token['type'] == 'blank_line':
-            parsed_tokens.append('')
-        elif token['type'] == 'directive':
-            parsed_tokens.append({
-                'str': token['value'],
-                'comment': token['comment']
-            })
-        elif token['type'] == 'directive':
-            parsed_tokens.append({
-                'str': token['value'],
-                'comment': token['comment']
-            })
-        elif token['type'] == 'data':
-            parsed_tokens.append({
-                'str': token['label'].ljust((max_label_size if config['align_data_section'] else len(token['label'])) + config['min_data_directive_spacing']) + token['directive'].ljust(max_size_size + config['min_data_initial_value_spacing']) + token['value'],
-                'comment': token['comment'],
-                'data': True
-            })
-            if config['align_data_comments'] and config['align_data_comments_separately']:
-                max_data_string_size = max(max_data_string_size, len(parsed_tokens[-1]['str']))
-        elif token['type'] == 'procedure':
-            parsed_tokens.append({
-                'str': token['label'] + ' ' + token['value'],
-                'comment': token['comment']
-            })
-            if token['value'] == 'PROC':
-                indent_counter += 1
-            else:
-                indent_counter -= 1
-        elif token['type'] == 'instruction':
-            parsed_tokens.append({
-                'str': token['mnemonic'].ljust((max_mnemonic_size if config['align_code_section'] else len(token['mnemonic'])) + config['min_instruction_operand_spacing']) + (token['operands'] or ''),
-                'comment': token['comment']
-            })
-
-        if not config['fix_indents']:
-            if type(parsed_tokens[-1]) is dict:
-                parsed_tokens[-1]['str'] = token['indent'] + parsed_tokens[-1]['str']
-            else:
-                parsed_tokens[-1] = token['indent'] + parsed_tokens[-1]
-        else:
-            if type(parsed_tokens[-1]) is dict:
-                parsed_tokens[-1]['str'] = ' '*(config['tab_size'] * indent_counter) + parsed_tokens[-1]['str']
-            else:
-                parsed_tokens[-1] = ' ' * (config['tab_size'] * indent_counter) + parsed_tokens[-1]
+                    parsed_tokens.append(OutputLine(indent + line, skip_wrap=True))
+                continue
+            case Procedure():
+                output_line = OutputLine(token.label + ' ' + token.value, token.comment)
+                if token.value == 'PROC':
+                    indent_counter += 1
+                else:
+                    indent_counter -= 1
+                indent_string = ' ' * (tab_size * indent_counter)
+            case _:
+                continue
 
-        if ((type(parsed_tokens[-1]) is dict and token['type'] != 'data') or (token['type'] == 'data' and config['align_data_comments'] and not config['align_data_comments_separately'])) and (token['type'] != 'comment' or token['subtype'] != 'full_line'):
-            max_string_size = max(max_string_size, len(parsed_tokens[-1]['str']))
+        output_line.string = (indent_string if fix_indents else token.indent) + output_line.string
+        parsed_tokens.append(output_line)
 
-    # Print the output
-    # with sys.stdout as output_file:
-    if output_file_name is None:
-        output_file = sys.stdout
-    else:
-        output_file = open(output_file_name, 'w')
+        if isinstance(token, (Instruction, Directive, Procedure)) or (isinstance(token, Data) and align_data_comments and not align_data_comments_separately):
+            max_string_size = max(max_string_size, len(output_line.string))
+
+    # Format the output
+    output_lines = []
+    long_comment_indent = ' ' * long_comment_indent_amount
     for line in parsed_tokens:
-        if type(line) is str:
-            print(line, file=output_file)
+        if not line.comment:
+            output_string = line.string.rstrip()
         else:
-            if (config['align_comments'] and 'data' not in line) or (config['align_comments'] and 'data' in line and config['align_data_comments'] and not config['align_data_comments_separately']):
-                output_string = line['str'].ljust(max_string_size + config['min_comment_spacing']) + ('; ' + line['comment'] if line['comment'] else '')
-            elif 'data' in line and config['align_data_comments'] and config['align_data_comments_separately']:
-                output_string = line['str'].ljust(max_data_string_size + config['min_comment_spacing']) + ('; ' + line['comment'] if line['comment'] else '')
+            if (align_comments and not line.is_data) or (align_comments and line.is_data and align_data_comments and not align_data_comments_separately):
+                comment_column = max_string_size + min_comment_spacing
+            elif line.is_data and align_data_comments and align_data_comments_separately:
+                comment_column = max_data_string_size + min_comment_spacing
             else:
-                output_string = line['str'] + ' '*config['min_comment_spacing'] + ('; ' + line['comment'] if line['comment'] else '')
+                comment_column = len(line.string) + min_comment_spacing
+            output_string = ''.join((line.string.ljust(comment_column), '; ', line.comment)).rstrip()
 
-            output_string = output_string.rstrip()
-            if not config['fix_file_width'] or len(output_string) <= config['file_width']:
-                print(output_string, file=output_file)
-            else:
-                while len(output_string) > config['file_width']:
-                    last_space = output_string.rfind(' ', 0, config['file_width'])
-                    print(output_string[:last_space], file=output_file)
-                    output_string = '; '.rjust(output_string.find(';') + 2) + ' '*config['long_comment_indent_amount'] + output_string[last_space + 1:]
-                print(output_string, file=output_file)
-    output_file.close()
+        if not fix_file_width or line.skip_wrap or len(output_string) <= file_width:
+            output_lines.append(output_string)
+        else:
+            continuation = ''.join((' ' * output_string.find(';'), '; ', long_comment_indent))
+            output_lines.extend(_wrap_line(output_string, file_width, continuation))
+
+    # Write the output
+    if output_file_name is None:
+        sys.stdout.writelines(f'{line}\n' for line in output_lines)
+    else:
+        with open(output_file_name, 'w', buffering=1 << 16) as output_file:
+            output_file.writelines(f'{line}\n' for line in output_lines)
 
           
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+"""Line classification for asm_fixer.
+
+This module is fully annotated and independent of the config so it can be
+compiled ahead of time with `mypyc asm_fixer_core.py`; the pure Python
+version is used when no compiled module is present.
+"""
+import re
+from dataclasses import dataclass
+
+_RE_DIRECTIVE_TOKEN = re.compile(r'\.?([a-zA-Z0-9.] ?)+')
+_RE_LINE = re.compile(
+    r'^(?:'
+    r'(?P<header>[^;]*;.*(?:Author|Assignment|Date).*:)'
+    r'|(?P<data>(?P<data_label>[a-zA-Z_][a-zA-Z0-9_]+)[ \t]+(?P<data_directive>BYTE|D?Q?WORD)[ \t]+(?P<data_value>(?:[0-9a-zA-Z,()?] ?|".+")+))'
+    r'|(?P<procedure>(?P<proc_label>[a-zA-Z_][a-zA-Z0-9_]*)[ \t]+(?P<proc_value>(?-i:PROC|ENDP)))'
+    r'|(?P<instruction>(?P<mnemonic>[a-zA-Z][a-zA-Z0-9]*)(?:[ \t]+(?P<operands>(?:[0-9a-zA-Z,] ?)+))?)'
+    r')',
+    re.IGNORECASE
+)
+
+
+@dataclass(slots=True, kw_only=True)
+class Token:
+    indent: str = ''
+
+
+@dataclass(slots=True)
+class BlankLine(Token):
+    pass
+
+
+@dataclass(slots=True)
+class Comment(Token):
+    subtype: str
+    value: str
+    field: str | None = None
+
+
+@dataclass(slots=True)
+class Directive(Token):
+    value: str
+    comment: str | None
+
+
+@dataclass(slots=True)
+class Data(Token):
+    label: str
+    directive: str
+    value: str
+    comment: str | None
+
+
+@dataclass(slots=True)
+class Procedure(Token):
+    label: str
+    value: str
+    comment: str | None
+
+
+@dataclass(slots=True)
+class Instruction(Token):
+    mnemonic: str
+    operands: str | None
+    comment: str | None
+
+
+@dataclass(slots=True)
+class Error(Token):
+    error: str
+    value: str
+
+
+def classify_line(line: str, tab_size: int, keep_indent: bool) -> Token:
+    # Preprocess Line
+    indent = line[:len(line) - len(line.lstrip(' \t'))].expandtabs(tab_size) if keep_indent else ''
+    line = line.strip()
+    semicolon = line.find(';')
+    has_comment = semicolon >= 0
+    comment = line[semicolon + 2:] if semicolon > 0 else None
+    is_comment = semicolon == 0
+    is_directive = line.startswith('.') or line.startswith('INCLUDE') or line.startswith('END', re.IGNORECASE)
+    maybe_header = False
+    if has_comment:
+        lower_line = line.lower()
+        maybe_header = 'author' in lower_line or 'assignment' in lower_line or 'date' in lower_line
+
+    # Only run the line pattern if the line could be a header or a line of code
+    line_match = None
+    if line and (maybe_header or not (is_comment or is_directive)):
+        line_match = _RE_LINE.match(line)
+    kind = line_match.lastgroup if line_match else None
+
+    token: Token
+    # Blank Line
+    if len(line) == 0:
+        token = BlankLine()
+    # Comment Extension
+    elif line.startswith(';  '):
+        token = Comment('extension', line[1:].strip())
+    # Header Comment
+    elif kind == 'header':
+        colon = line.find(':')
+        token = Comment('header', line[colon + 1:].strip(), field=line[1:colon].strip())
+    # Full-line Comment
+    elif is_comment:
+        token = Comment('full_line', line[1:].strip())
+    # Directive
+    elif is_directive:
+        directive_match = _RE_DIRECTIVE_TOKEN.match(line)
+        assert directive_match is not None
+        token = Directive(directive_match.group(0).strip(), comment)
+    # Data Value
+    elif kind == 'data':
+        assert line_match is not None
+        token = Data(
+            line_match.group('data_label'),
+            line_match.group('data_directive'),
+            line_match.group('data_value').strip(),
+            comment
+        )
+    # Procedure
+    elif kind == 'procedure':
+        assert line_match is not None
+        token = Procedure(line_match.group('proc_label'), line_match.group('proc_value'), comment)
+    # Instruction/Macro
+    elif kind == 'instruction':
+        assert line_match is not None
+        token = Instruction(
+            line_match.group('mnemonic'),
+            line_match.group('operands').strip() if line_match.group('operands') is not None else None,
+            comment
+        )
+    # Unrecognized
+    else:
+        token = Error('Unrecognized Token', line)
+
+    token.indent = indent
+    return token